@@ -3,19 +3,112 @@
 #author : Bryce Wade Pearson
 """A script to pull information from ECS for EC2 vs. Fargate comparison."""
 import argparse
+import asyncio
+import bisect
 import datetime
-import json
 import os
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import diskcache
+import jmespath
+import orjson
 import xlsxwriter
+from botocore.config import Config
+
+
+# Remembers values and makes sure that when several threads ask for the same
+# missing value at the same time only one of them actually goes and gets it
+class Coalescer:
+    """A thread-safe cache that coalesces concurrent lookups of a key."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.pending = {}
+
+    def get(self, key, fetch=None):
+        """Return the value for a key, calling fetch once if it is missing."""
+        with self.lock:
+            if key in self.values:
+                return self.values[key]
+            if fetch is None:
+                return None
+            request = self.pending.get(key)
+            if request is None:
+                request = {'event': threading.Event(), 'error': None}
+                self.pending[key] = request
+                fetching = True
+            else:
+                fetching = False
+        if not fetching:
+            # Someone else is already getting this one, wait for them and
+            # fail the same way they did if it didn't work out
+            request['event'].wait()
+            if request['error'] is not None:
+                raise request['error']
+            with self.lock:
+                return self.values.get(key)
+        try:
+            value = fetch()
+            if value is not None:
+                self.set(key, value)
+            return value
+        except Exception as error:
+            request['error'] = error
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            request['event'].set()
+
+    def set(self, key, value):
+        """Remember the value for a key."""
+        with self.lock:
+            self.values[key] = value
+
 
 ##########
 # Globals
 ##########
 
-price_history = {}
+# Prices are remembered for this run in price_history, and between runs in
+# an on-disk cache since AWS prices rarely change
+price_history = Coalescer()
+price_cache = diskcache.Cache(os.path.expanduser('~/.cache/fargate-tool'))
+PRICE_CACHE_TTL = 30 * 86400
+
+# Precompiled paths to the parts of a Pricing API price entry that we use
+USAGE_TYPE_PATH = jmespath.compile('product.attributes.usagetype')
+INSTANCE_TYPE_PATH = jmespath.compile('product.attributes.instanceType')
+ON_DEMAND_PRICE_PATH = jmespath.compile(
+    'values(terms.OnDemand || `{}`)[]'
+    '.values(priceDimensions || `{}`)[].pricePerUnit.USD | [0]')
+
+# Task definitions are often shared between services and clusters, so only
+# describe each one once per run
+task_definition_history = {}
+
+# boto3 clients are expensive to create but safe to share between threads,
+# so we only make one of each
+ecs_client = None
+pricing_client = None
+client_lock = threading.Lock()
+
+# Gathering clusters in parallel pushes the AWS API call rate up, so let
+# botocore back off and retry when we get throttled, and give it enough
+# connections that the worker threads aren't queuing up for them
+AWS_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 15},
+    max_pool_connections=32,
+    tcp_keepalive=True
+)
+GATHER_WORKERS = 16
+DESCRIBE_SERVICES_BATCH = 10
+DESCRIBE_CONTAINER_INSTANCES_BATCH = 100
+# Maximum number of ECS API calls in flight at once when using --async
+ASYNC_CONCURRENCY = 20
 
 REGION_MAP = {
     "ap-northeast-1": "Asia Pacific (Tokyo)",
@@ -43,6 +136,10 @@ FARGATE_SIZES = {
     2: range(4, 17),
     4: range(8, 31)
 }
+# Sorted CPU sizes and their memory options so we don't have to re-sort
+# them for every task
+FARGATE_CPUS = sorted(FARGATE_SIZES)
+FARGATE_MEMORY = {cpu: tuple(FARGATE_SIZES[cpu]) for cpu in FARGATE_CPUS}
 
 
 def datetimeconverter(item):
@@ -105,45 +202,82 @@ def parse_args():
         help='Percentage value of discount to calculate on '
              'Fargate specitic AWS costs (0-100)')
 
+    parser.add_argument(
+        '-a',
+        '--async',
+        dest='use_async',
+        action="store_true",
+        help='Gather cluster info with asyncio and aiobotocore instead of '
+             'a thread pool')
+
     args = vars(parser.parse_args())
 
+    # Make sure we know where to look up prices before we do any real work
+    region = (args.get('region') or '').lower()
+    location = REGION_MAP.get(region)
+    if location is None:
+        parser.error('unsupported region {}; supported: {}'.format(
+            region, ', '.join(sorted(REGION_MAP))))
+
+    filename = args.get('filename')
+    if not filename.lower().endswith('.xlsx'):
+        filename = filename + '.xlsx'
+
     # Here we're modifying meatbag friendly values to values
     # that python can more readily use
     args = {
         'aws_discount': float(args.get('aws_discount') / 100),
         'cpu_fudge': 1 + float(args.get('cpu_fudge') / 100),
         'fargate_discount': float(args['fargate_discount'] / 100),
-        'filename': args.get('filename')+".xlsx"
-        if not re.search(r"\.xlsx$", args['filename'], re.IGNORECASE)
-        else args.get('filename'),
-        'region': args.get('region').lower()
+        'filename': filename,
+        'location': location,
+        'region': region,
+        'use_async': args.get('use_async')
     }
 
     return args
 
 
+def get_ecs_client():
+    """Return the shared ECS client."""
+    global ecs_client
+    with client_lock:
+        if ecs_client is None:
+            ecs_client = boto3.client('ecs', config=AWS_CONFIG)
+        return ecs_client
+
+
+def get_pricing_client():
+    """Return the shared AWS Pricing API client."""
+    global pricing_client
+    with client_lock:
+        if pricing_client is None:
+            pricing_client = boto3.client('pricing', region_name='us-east-1',
+                                          config=AWS_CONFIG)
+        return pricing_client
+
+
+# ECS ARNs look like arn:aws:ecs:region:account:cluster/name, and all we
+# want to show people is the name on the end
+def get_display_name(arn):
+    """Return the name from the end of an ECS ARN."""
+    return arn.rsplit('/', 1)[-1]
+
+
 def get_cluster_list(client):
     """Return a list of cluster ARNs."""
     paginator = client.get_paginator('list_clusters')
-    response_iterator = paginator.paginate()
+    response_iterator = paginator.paginate(
+        PaginationConfig={'PageSize': 100}
+    )
     clusters = []
     for response in response_iterator:
         clusters.extend(response.get('clusterArns', []))
     return clusters
 
 
-# Given a list of dictionaries return the one with the correct name
-# (We could probably do this with a lambda call, but I think this is easier
-# to read)
-def find_dict(name, list_of_dicts):
-    """Return the dictionary with the specified name."""
-    for entry in list_of_dicts:
-        if entry['name'] == name:
-            return entry
-    return None
-
-
-# In a list of maps that looks like this return the value for a specified name
+# Turn a list of maps that looks like this into a map keyed on the names so
+# we can pull out entries without scanning the list every time
 # [
 #     {
 #         "name": "sample_name1",
@@ -153,57 +287,188 @@ def find_dict(name, list_of_dicts):
 #         "value": "sample_value2"
 #     }
 # ]
-def get_attribute(attribute, instance):
-    """Return the value for a dictionary matching the specified name."""
-    entry = find_dict(attribute, instance.get('attributes', []))
-    if entry is not None:
-        return entry.get('value')
-    return None
+def index_by_name(list_of_dicts):
+    """Return the dictionaries in a list keyed by their name."""
+    return {entry['name']: entry for entry in list_of_dicts}
 
 
 # Gather the info about an EC2 instance that is part of an ECS cluster
 def get_instance_info(instance):
     """Return size info for a specified ECS EC2 instance."""
+    attributes = index_by_name(instance.get('attributes', []))
+    remaining_resources = index_by_name(
+        instance.get('remainingResources', []))
+    registered_resources = index_by_name(
+        instance.get('registeredResources', []))
     info = {}
-    info['instance-type'] = get_attribute('ecs.instance-type', instance)
-    remaining_resources = instance.get('remainingResources', {})
-    remaining_cpu = find_dict('CPU', remaining_resources)
-    info['remaining_cpu'] = remaining_cpu.get('integerValue')
-    remaining_memory = find_dict('MEMORY', remaining_resources)
-    info['remaining_memory'] = remaining_memory.get('integerValue')
-    registered_resources = instance.get('registeredResources', {})
-    total_cpu = find_dict('CPU', registered_resources)
-    info['total_cpu'] = total_cpu.get('integerValue')
-    total_memory = find_dict('MEMORY', registered_resources)
-    info['total_memory'] = total_memory.get('integerValue')
+    info['instance-type'] = attributes.get(
+        'ecs.instance-type', {}).get('value')
+    info['remaining_cpu'] = remaining_resources['CPU'].get('integerValue')
+    info['remaining_memory'] = remaining_resources['MEMORY'].get(
+        'integerValue')
+    info['total_cpu'] = registered_resources['CPU'].get('integerValue')
+    info['total_memory'] = registered_resources['MEMORY'].get('integerValue')
     return info
 
 
+def new_running_total():
+    """Return an empty running total for an ECS cluster."""
+    return {
+        'instance-type': None,
+        'instance-count': 0,
+        'remaining_cpu': 0,
+        'remaining_memory': 0,
+        'total_cpu': 0,
+        'total_memory': 0
+    }
+
+
 # Add up the size info about the cluster
 def add_to_running_total(info, total):
     """Add the new info to the running total for an ECS cluster."""
     total['instance-type'] = info['instance-type']
-    total['instance-count'] = total.get('instance-count', 0) + 1
-    total['remaining_cpu'] = total.get(
-        'remaining_cpu', 0) + info['remaining_cpu']
-    total['remaining_memory'] = total.get(
-        'remaining_memory', 0) + info['remaining_memory']
-    total['total_cpu'] = total.get('total_cpu', 0) + info['total_cpu']
-    total['total_memory'] = total.get('total_memory', 0) + info['total_memory']
+    total['instance-count'] += 1
+    total['remaining_cpu'] += info['remaining_cpu']
+    total['remaining_memory'] += info['remaining_memory']
+    total['total_cpu'] += info['total_cpu']
+    total['total_memory'] += info['total_memory']
     return total
 
 
-def get_ec2_price(instance_type, aws_discount, region):
-    """Pull the current price of an EC2 instance type for the given region."""
-    price = price_history.get(instance_type)
-    if price is not None:
-        return price
-    client = boto3.client('pricing', region_name='us-east-1')
-    # We need to filter things down enough that we only get the price we
-    # want
-    response = client.get_products(
+# Look a price up in our in-process history, then the on-disk cache, and only
+# then go out to the AWS Pricing API
+def get_cached_price(key, fetch):
+    """Return the price for a key, calling fetch on a cache miss."""
+    return price_history.get(key, lambda: load_price(key, fetch))
+
+
+def load_price(key, fetch):
+    """Return the price for a key from the on-disk cache or from fetch."""
+    price = price_cache.get(key)
+    if price is None:
+        price = fetch()
+        if price is not None:
+            price_cache.set(key, price, expire=PRICE_CACHE_TTL)
+    return price
+
+
+# Dig the on-demand USD price out of an entry from the Pricing API
+def get_on_demand_price(price_entry):
+    """Return the on-demand list price for a Pricing API price entry."""
+    return ON_DEMAND_PRICE_PATH.search(price_entry)
+
+
+# Page through the products matching the filters until we find the one with
+# the usage type we want.  The right entry isn't guaranteed to be the first
+# one, or even on the first page.
+def find_price(service_code, filters, usage_type_suffix):
+    """Return the on-demand list price of the first matching product."""
+    client = get_pricing_client()
+    paginator = client.get_paginator('get_products')
+    response_iterator = paginator.paginate(
+        ServiceCode=service_code,
+        Filters=filters,
+        PaginationConfig={'PageSize': 100}
+    )
+    for response in response_iterator:
+        for entry in response.get('PriceList', []):
+            price_entry = orjson.loads(entry)
+            usage_type = USAGE_TYPE_PATH.search(price_entry) or ''
+            if usage_type.endswith(usage_type_suffix):
+                list_price = get_on_demand_price(price_entry)
+                if list_price:
+                    return list_price
+    return None
+
+
+# Rather than asking the Pricing API about one instance type at a time, pull
+# all the Linux instance prices for the region in a single paginated pass
+def prefetch_ec2_prices(location, aws_discount, instance_types):
+    """Load the prices for the given EC2 instance types into price_history."""
+    missing = set()
+    for instance_type in instance_types:
+        key = ('ec2', instance_type, location, aws_discount)
+        if price_history.get(key) is not None:
+            continue
+        price = price_cache.get(key)
+        if price is None:
+            missing.add(instance_type)
+        else:
+            price_history.set(key, price)
+    if not missing:
+        return
+    client = get_pricing_client()
+    paginator = client.get_paginator('get_products')
+    response_iterator = paginator.paginate(
         ServiceCode='AmazonEC2',
         Filters=[
+            {
+                'Type': 'TERM_MATCH',
+                'Field': 'location',
+                'Value': location
+            },
+            {
+                'Type': 'TERM_MATCH',
+                'Field': 'operatingSystem',
+                'Value': 'Linux'
+            },
+            {
+                'Type': 'TERM_MATCH',
+                'Field': 'preInstalledSw',
+                'Value': 'NA'
+            },
+            {
+                'Type': 'TERM_MATCH',
+                'Field': 'tenancy',
+                'Value': 'Shared'
+            },
+            {
+                'Type': 'TERM_MATCH',
+                'Field': 'capacitystatus',
+                'Value': 'UnusedCapacityReservation'
+            }
+        ],
+        PaginationConfig={'PageSize': 100}
+    )
+    # Remember every price we see, not just the ones we were asked about, so
+    # later runs against other clusters don't need to ask again.  Stop paging
+    # as soon as we have all the ones we need though.
+    prices = {}
+    for response in response_iterator:
+        for entry in response.get('PriceList', []):
+            price_entry = orjson.loads(entry)
+            instance_type = INSTANCE_TYPE_PATH.search(price_entry)
+            usage_type = USAGE_TYPE_PATH.search(price_entry) or ''
+            if not usage_type.endswith('UnusedBox:{}'.format(instance_type)):
+                continue
+            list_price = get_on_demand_price(price_entry)
+            if list_price:
+                key = ('ec2', instance_type, location, aws_discount)
+                prices[key] = float(list_price) * (1 - aws_discount)
+                missing.discard(instance_type)
+        if not missing:
+            break
+    # Write them all to disk in one short transaction
+    with price_cache.transact():
+        for key, price in prices.items():
+            price_history.set(key, price)
+            price_cache.set(key, price, expire=PRICE_CACHE_TTL)
+
+
+def get_ec2_price(instance_type, aws_discount, location):
+    """Return the price of an EC2 instance type for the given location."""
+    return get_cached_price(
+        ('ec2', instance_type, location, aws_discount),
+        lambda: fetch_ec2_price(instance_type, aws_discount, location))
+
+
+def fetch_ec2_price(instance_type, aws_discount, location):
+    """Pull the current price of an EC2 instance type for a location."""
+    # We need to filter things down enough that we only get the price we
+    # want
+    list_price = find_price(
+        'AmazonEC2',
+        [
             {
                 'Type': 'TERM_MATCH',
                 'Field': 'instanceType',
@@ -217,46 +482,34 @@ def get_ec2_price(instance_type, aws_discount, region):
             {
                 'Type': 'TERM_MATCH',
                 'Field': 'location',
-                'Value': REGION_MAP[region]
+                'Value': location
             },
             {
                 'Type': 'TERM_MATCH',
                 'Field': 'preInstalledSw',
                 'Value': 'NA'
             }
-        ]
+        ],
+        'UnusedBox:{}'.format(instance_type)
     )
-    pricelist = response.get('PriceList', [])
-    # parse through the returned price list and return the price we are looking
-    # for
-    for entry in pricelist:
-        price_entry = json.loads(entry)
-        usage_type = price_entry.get('product', {}).get(
-            'attributes', {}).get('usagetype')
-        if usage_type.endswith('UnusedBox:{}'.format(instance_type)):
-            terms = price_entry.get('terms', {})
-            on_demand = terms.get('OnDemand', {})
-            offer_term = next(iter(on_demand.values()))
-            rate_code = next(
-                iter(offer_term.get('priceDimensions', {}).values()))
-            list_price = rate_code.get('pricePerUnit', {}).get('USD')
-            if list_price:
-                price = float(list_price) * (1 - aws_discount)
-                price_history[instance_type] = price
-                return price
+    if list_price:
+        return float(list_price) * (1 - aws_discount)
     return None
 
 
-def get_fargate_cpu_price(fargate_discount, region):
-    """Pull the current Fargate CPU cost for the given region."""
-    price = price_history.get('fargate_cpu')
-    if price is not None:
-        return price
-    client = boto3.client('pricing', region_name='us-east-1')
+def get_fargate_cpu_price(fargate_discount, location):
+    """Return the Fargate CPU cost for the given location."""
+    return get_cached_price(
+        ('fargate_cpu', '', location, fargate_discount),
+        lambda: fetch_fargate_cpu_price(fargate_discount, location))
+
+
+def fetch_fargate_cpu_price(fargate_discount, location):
+    """Pull the current Fargate CPU cost for the given location."""
     # Filter the prices down
-    response = client.get_products(
-        ServiceCode='AmazonECS',
-        Filters=[
+    list_price = find_price(
+        'AmazonECS',
+        [
             {
                 'Type': 'TERM_MATCH',
                 'Field': 'cputype',
@@ -270,34 +523,28 @@ def get_fargate_cpu_price(fargate_discount, region):
             {
                 'Type': 'TERM_MATCH',
                 'Field': 'location',
-                'Value': REGION_MAP[region]
+                'Value': location
             }
-        ]
+        ],
+        'Fargate-vCPU-Hours:perCPU'
     )
-    pricelist = response.get('PriceList', [])
-    if pricelist:
-        price_entry = json.loads(pricelist[0])
-        terms = price_entry.get('terms', {})
-        on_demand = terms.get('OnDemand', {})
-        offer_term = next(iter(on_demand.values()))
-        rate_code = next(iter(offer_term.get('priceDimensions', {}).values()))
-        list_price = rate_code.get('pricePerUnit', {}).get('USD')
-        if list_price:
-            price = float(list_price) * (1 - fargate_discount)
-            price_history['fargate_cpu'] = price
-            return price
+    if list_price:
+        return float(list_price) * (1 - fargate_discount)
     return None
 
 
-def get_fargate_memory_price(fargate_discount, region):
-    """Pull the current Fargate memory cost for the given region."""
-    price = price_history.get('fargate_memory')
-    if price is not None:
-        return price
-    client = boto3.client('pricing', region_name='us-east-1')
-    response = client.get_products(
-        ServiceCode='AmazonECS',
-        Filters=[
+def get_fargate_memory_price(fargate_discount, location):
+    """Return the Fargate memory cost for the given location."""
+    return get_cached_price(
+        ('fargate_memory', '', location, fargate_discount),
+        lambda: fetch_fargate_memory_price(fargate_discount, location))
+
+
+def fetch_fargate_memory_price(fargate_discount, location):
+    """Pull the current Fargate memory cost for the given location."""
+    list_price = find_price(
+        'AmazonECS',
+        [
             {
                 'Type': 'TERM_MATCH',
                 'Field': 'memorytype',
@@ -311,22 +558,13 @@ def get_fargate_memory_price(fargate_discount, region):
             {
                 'Type': 'TERM_MATCH',
                 'Field': 'location',
-                'Value': REGION_MAP[region]
+                'Value': location
             }
-        ]
+        ],
+        'Fargate-GB-Hours'
     )
-    pricelist = response.get('PriceList', [])
-    if pricelist:
-        price_entry = json.loads(pricelist[0])
-        terms = price_entry.get('terms', {})
-        on_demand = terms.get('OnDemand', {})
-        offer_term = next(iter(on_demand.values()))
-        rate_code = next(iter(offer_term.get('priceDimensions', {}).values()))
-        list_price = rate_code.get('pricePerUnit', {}).get('USD')
-        if list_price:
-            price = float(list_price) * (1 - fargate_discount)
-            price_history['fargate_memory'] = price
-            return price
+    if list_price:
+        return float(list_price) * (1 - fargate_discount)
     return None
 
 
@@ -335,8 +573,11 @@ def get_fargate_memory_price(fargate_discount, region):
 def get_container_stats(client, cluster):
     """Return infomation about ECS EC2 instances for a cluster."""
     paginator = client.get_paginator('list_container_instances')
-    response_iterator = paginator.paginate(cluster=cluster)
-    running_total = {}
+    response_iterator = paginator.paginate(
+        cluster=cluster,
+        PaginationConfig={'PageSize': 100}
+    )
+    running_total = new_running_total()
     for response in response_iterator:
         instances = response.get('containerInstanceArns', [])
         if instances:
@@ -346,7 +587,7 @@ def get_container_stats(client, cluster):
             )
             for instance in instance_response.get('containerInstances', []):
                 info = get_instance_info(instance)
-                running_total = add_to_running_total(info, running_total)
+                add_to_running_total(info, running_total)
     return running_total
 
 
@@ -354,18 +595,28 @@ def get_container_stats(client, cluster):
 # worksheet
 def add_row_to_sheet(worksheet, row, data):
     """Add an entire row to the Excel worksheet."""
-    column = 0
-    for value in data:
-        worksheet.write(row, column, value)
-        column = column + 1
+    worksheet.write_row(row, 0, data)
 
 
 def create_ec2_sheet(workbook, currency_fmt, percent_fmt,
-                     cluster_totals, args):
+                     cluster_totals, cluster_names, args):
     """Create an Excel worksheet for the EC2 usage in a region."""
     aws_discount = args['aws_discount']
-    region = args['region']
+    location = args['location']
+    # Look up the price of each instance type once rather than once per row
+    ec2_prices = {
+        instance_type: get_ec2_price(instance_type, aws_discount, location)
+        for instance_type in {totals['instance-type']
+                              for totals in cluster_totals.values()
+                              if totals['instance-count']}
+    }
     worksheet = workbook.add_worksheet('EC2 Usage')
+    # Column formats have to be set before any rows are written, since rows
+    # are flushed to disk as soon as we move past them
+    # Set columns D and E as currency
+    worksheet.set_column('D:E', None, currency_fmt)
+    # And columns L and M as percentages
+    worksheet.set_column('L:M', None, percent_fmt)
     add_row_to_sheet(worksheet, 0, [
         'Cluster',
         'Instance Type',
@@ -383,16 +634,16 @@ def create_ec2_sheet(workbook, currency_fmt, percent_fmt,
     ])
     row = 0
     for cluster, totals in sorted(cluster_totals.items()):
-        if totals:
+        if totals['instance-count']:
             row = row + 1
             # Populate unique data with numbers, but allow Excel to calculate
             # as much data as possible so that humans can easily play see
             # what-if scenarios
             add_row_to_sheet(worksheet, row, [
-                cluster.split("/")[1],
+                cluster_names[cluster],
                 totals['instance-type'],
                 totals['instance-count'],
-                get_ec2_price(totals['instance-type'], aws_discount, region),
+                ec2_prices[totals['instance-type']],
                 '=C{0}*D{0}'.format(row + 1),
                 '=H{0}-G{0}'.format(row + 1),
                 totals['remaining_cpu'],
@@ -403,19 +654,17 @@ def create_ec2_sheet(workbook, currency_fmt, percent_fmt,
                 '=G{0}/H{0}'.format(row + 1),
                 '=J{0}/K{0}'.format(row + 1)
             ])
-    # Set columns D and E as currency
-    worksheet.set_column('D:E', None, currency_fmt)
-    # And columns L and M as percentages
-    worksheet.set_column('L:M', None, percent_fmt)
     return row + 1
 
 
 def get_services(client, cluster):
     """Return a list of services for a given ECS cluster."""
     paginator = client.get_paginator('list_services')
+    # list_services only returns 10 services per page unless we ask for more
     response_iterator = paginator.paginate(
         cluster=cluster,
-        schedulingStrategy='REPLICA'
+        schedulingStrategy='REPLICA',
+        PaginationConfig={'PageSize': 100}
     )
     services = []
     # Cycle through all the pages and add the serviceArns to our list of
@@ -427,20 +676,35 @@ def get_services(client, cluster):
 
 def adjust_task_size(task_cpu, task_mem, cpu_fudge_factor):
     """Return a valid Fargate configuration for specified cpu and memory."""
-    for cpu in sorted(FARGATE_SIZES.keys()):
-        if task_cpu < cpu * cpu_fudge_factor:
-            for mem in FARGATE_SIZES[cpu]:
-                if task_mem < mem:
-                    return (cpu, mem)
+    # Skip straight to the smallest CPU size that is big enough
+    first = bisect.bisect_right(FARGATE_CPUS, task_cpu / cpu_fudge_factor)
+    for cpu in FARGATE_CPUS[first:]:
+        for mem in FARGATE_MEMORY[cpu]:
+            if task_mem < mem:
+                return (cpu, mem)
     return (None, None)
 
 
+def get_task_definition(client, task_def):
+    """Return the description of a task definition."""
+    task_definition = task_definition_history.get(task_def)
+    if task_definition is None:
+        response = client.describe_task_definition(taskDefinition=task_def)
+        task_definition = response.get('taskDefinition', {})
+        task_definition_history[task_def] = task_definition
+    return task_definition
+
+
 def get_task_size(client, task_def, cpu_fudge_factor):
     """Return the size information for a given task definition."""
     if task_def is None:
         return {}
-    response = client.describe_task_definition(taskDefinition=task_def)
-    task_definition = response.get('taskDefinition', {})
+    return calculate_task_size(get_task_definition(client, task_def),
+                               cpu_fudge_factor)
+
+
+def calculate_task_size(task_definition, cpu_fudge_factor):
+    """Return the size information for a task definition description."""
     containers = task_definition.get('containerDefinitions', [])
     cpu = 0
     memory = 0
@@ -461,40 +725,186 @@ def get_task_size(client, task_def, cpu_fudge_factor):
     return task_size
 
 
-def get_service_info(client, cluster, service, cpu_fudge_factor):
+# The ECS API will describe up to 10 services per call, so ask about them in
+# batches instead of one at a time
+def describe_services(client, cluster, service_list):
+    """Return the descriptions of the given services in an ECS cluster."""
+    descriptions = []
+    for i in range(0, len(service_list), DESCRIBE_SERVICES_BATCH):
+        response = client.describe_services(
+            cluster=cluster,
+            services=service_list[i:i + DESCRIBE_SERVICES_BATCH]
+        )
+        descriptions.extend(response.get('services', []))
+    return descriptions
+
+
+def get_service_info(description, task_sizes):
     """Return the size information of a given service."""
-    response = client.describe_services(
-        cluster=cluster,
-        services=[service]
-    )
-    services = response.get('services')
-    # Cycle through all the services and get info about them
-    if services:
-        task_def = services[0].get('taskDefinition')
-        running = int(services[0].get('runningCount', 0))
-        if running == 0:
-            return {}
-        service_info = get_task_size(client, task_def, cpu_fudge_factor)
-        service_info['running'] = running
-        return service_info
-    return {}
+    running = int(description.get('runningCount', 0))
+    if running == 0:
+        return {}
+    service_info = dict(task_sizes.get(description.get('taskDefinition'), {}))
+    service_info['running'] = running
+    return service_info
+
+
+# Lots of services can share a task definition, so we only want to look up
+# each one that is actually running once
+def get_running_task_defs(descriptions):
+    """Return the distinct task definitions used by running services."""
+    return {description['taskDefinition'] for description in descriptions
+            if int(description.get('runningCount', 0)) > 0
+            and description.get('taskDefinition')}
+
+
+def summarize_services(descriptions, task_sizes):
+    """Return the size information for each of the described services."""
+    services = {}
+    for description in descriptions:
+        name = get_display_name(description['serviceArn'])
+        services[name] = get_service_info(description, task_sizes)
+    return services
 
 
 def get_service_stats(ecs, cluster, cpu_fudge_factor):
     """Gather the service size stats for a given cluster."""
     service_list = get_services(ecs, cluster)
-    services = {}
-    for service in service_list:
-        service_info = get_service_info(ecs, cluster, service,
-                                        cpu_fudge_factor)
-        services[service] = service_info
-    return services
+    descriptions = describe_services(ecs, cluster, service_list)
+    task_sizes = {task_def: get_task_size(ecs, task_def, cpu_fudge_factor)
+                  for task_def in get_running_task_defs(descriptions)}
+    return summarize_services(descriptions, task_sizes)
+
+
+# Gather all the EC2 and service info for a single cluster.  This runs in a
+# worker thread alongside the other clusters.
+def gather_cluster_info(cluster, cpu_fudge_factor):
+    """Return the EC2 and service stats for a given ECS cluster."""
+    print("Gathering info for ECS Cluster {}".format(
+        get_display_name(cluster)))
+    ecs = get_ecs_client()
+    return (cluster,
+            get_container_stats(ecs, cluster),
+            get_service_stats(ecs, cluster, cpu_fudge_factor))
+
+
+#####################################################################
+# asyncio versions of the gathering functions, used with --async
+#####################################################################
+
+async def call_async(semaphore, method, **kwargs):
+    """Call an aiobotocore client method once there is room to do so."""
+    async with semaphore:
+        return await method(**kwargs)
+
+
+async def paginate_async(client, semaphore, operation, key, **kwargs):
+    """Return every item under key from a paginated ECS operation."""
+    paginator = client.get_paginator(operation)
+    items = []
+    async with semaphore:
+        async for response in paginator.paginate(**kwargs):
+            items.extend(response.get(key, []))
+    return items
+
+
+async def get_container_stats_async(client, semaphore, cluster):
+    """Return infomation about ECS EC2 instances for a cluster."""
+    instances = await paginate_async(
+        client, semaphore, 'list_container_instances',
+        'containerInstanceArns', cluster=cluster,
+        PaginationConfig={'PageSize': 100})
+    responses = await asyncio.gather(*[
+        call_async(semaphore, client.describe_container_instances,
+                   cluster=cluster,
+                   containerInstances=instances[
+                       i:i + DESCRIBE_CONTAINER_INSTANCES_BATCH])
+        for i in range(0, len(instances), DESCRIBE_CONTAINER_INSTANCES_BATCH)
+    ])
+    running_total = new_running_total()
+    for response in responses:
+        for instance in response.get('containerInstances', []):
+            info = get_instance_info(instance)
+            add_to_running_total(info, running_total)
+    return running_total
+
+
+async def describe_services_async(client, semaphore, cluster):
+    """Return the descriptions of all the services in an ECS cluster."""
+    service_list = await paginate_async(
+        client, semaphore, 'list_services', 'serviceArns',
+        cluster=cluster, schedulingStrategy='REPLICA',
+        PaginationConfig={'PageSize': 100})
+    responses = await asyncio.gather(*[
+        call_async(semaphore, client.describe_services,
+                   cluster=cluster,
+                   services=service_list[i:i + DESCRIBE_SERVICES_BATCH])
+        for i in range(0, len(service_list), DESCRIBE_SERVICES_BATCH)
+    ])
+    return [description for response in responses
+            for description in response.get('services', [])]
+
+
+async def describe_task_definitions_async(client, semaphore, task_defs):
+    """Load the given task definitions into task_definition_history."""
+    task_defs = [task_def for task_def in task_defs
+                 if task_def not in task_definition_history]
+    responses = await asyncio.gather(*[
+        call_async(semaphore, client.describe_task_definition,
+                   taskDefinition=task_def)
+        for task_def in task_defs
+    ])
+    for task_def, response in zip(task_defs, responses):
+        task_definition_history[task_def] = response.get('taskDefinition', {})
+
+
+# Gather all the EC2 and service info for every cluster at once.  The
+# services for all the clusters are described before any task definitions so
+# that a task definition shared between clusters is only looked up once.
+async def gather_clusters_async(clusters, cpu_fudge_factor):
+    """Return the EC2 and service stats for the given ECS clusters."""
+    # aiobotocore is only needed for --async, and it pins botocore tightly,
+    # so don't make everyone install it
+    from aiobotocore.session import get_session
+
+    semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    session = get_session()
+    async with session.create_client('ecs', config=AWS_CONFIG) as client:
+        for cluster in clusters:
+            print("Gathering info for ECS Cluster {}".format(
+                get_display_name(cluster)))
+        container_stats, service_descriptions = await asyncio.gather(
+            asyncio.gather(*[
+                get_container_stats_async(client, semaphore, cluster)
+                for cluster in clusters]),
+            asyncio.gather(*[
+                describe_services_async(client, semaphore, cluster)
+                for cluster in clusters])
+        )
+        task_defs = set()
+        for descriptions in service_descriptions:
+            task_defs.update(get_running_task_defs(descriptions))
+        await describe_task_definitions_async(client, semaphore, task_defs)
+
+    cluster_ec2_totals = dict(zip(clusters, container_stats))
+    cluster_ecs_totals = {}
+    for cluster, descriptions in zip(clusters, service_descriptions):
+        task_sizes = {
+            task_def: calculate_task_size(task_definition_history[task_def],
+                                          cpu_fudge_factor)
+            for task_def in get_running_task_defs(descriptions)}
+        cluster_ecs_totals[cluster] = summarize_services(descriptions,
+                                                         task_sizes)
+    return cluster_ec2_totals, cluster_ecs_totals
 
 
 def create_fargate_sheet(workbook, currency_fmt, cluster_info,
-                         fargate_discount, region):
+                         cluster_names, fargate_discount, location):
     """Create an Excel worksheet for the proposed Fargate usage in a region."""
+    fargate_cpu_price = get_fargate_cpu_price(fargate_discount, location)
+    fargate_memory_price = get_fargate_memory_price(fargate_discount, location)
     worksheet = workbook.add_worksheet('Fargate Usage')
+    worksheet.set_column('H:L', None, currency_fmt)
     add_row_to_sheet(worksheet, 0, [
         'Cluster',
         'Service',
@@ -518,28 +928,28 @@ def create_fargate_sheet(workbook, currency_fmt, cluster_info,
             if value.get('running', 0) > 0:
                 row = row + 1
                 add_row_to_sheet(worksheet, row, [
-                    cluster.split("/")[1],
-                    service.split("/")[-1],
+                    cluster_names[cluster],
+                    service,
                     value['running'],
                     value['cpu'],
                     value['mem'],
                     value['vcpu'],
                     value['GB'],
-                    get_fargate_cpu_price(fargate_discount, region),
+                    fargate_cpu_price,
                     '=C{0}*F{0}*H{0}'.format(row + 1),
-                    get_fargate_memory_price(fargate_discount, region),
+                    fargate_memory_price,
                     '=C{0}*G{0}*J{0}'.format(row + 1),
                     '=I{}+K{}'.format(row + 1, row + 1),
                 ])
-    worksheet.set_column('H:L', None, currency_fmt)
     return row + 1
 
 
-def create_comparison_sheet(workbook, currency_fmt,
-                            cluster_totals, ec2_rows, fargate_rows):
+def create_comparison_sheet(workbook, currency_fmt, cluster_totals,
+                            cluster_names, ec2_rows, fargate_rows):
     """Create an Excel worksheet comparing the EC2 & Fargate usage."""
     sheetname = 'Comparison'
     worksheet = workbook.add_worksheet(sheetname)
+    worksheet.set_column('B:C', None, currency_fmt)
     add_row_to_sheet(worksheet, 0, [
         'Cluster',
         'Fargate Cost',
@@ -552,10 +962,10 @@ def create_comparison_sheet(workbook, currency_fmt,
     # in Fargate.  Again, use formulas so humans can more easily evaluate
     # what-if scenarios
     for cluster, totals in sorted(cluster_totals.items()):
-        if totals:
+        if totals['instance-count']:
             row = row + 1
             add_row_to_sheet(worksheet, row, [
-                cluster.split("/")[1],
+                cluster_names[cluster],
                 ("=SUMIF('Fargate Usage'!A2:A{0},{1}!A{2},"
                  "'Fargate Usage'!L2:L{0})").format(
                      fargate_rows, sheetname, row + 1),
@@ -563,7 +973,6 @@ def create_comparison_sheet(workbook, currency_fmt,
                     row + 1, ec2_rows),
                 '=IF(B{0}<C{0},"Fargate", "EC2")'.format(row + 1)
             ])
-    worksheet.set_column('B:C', None, currency_fmt)
 
 
 def create_wasted_cpu_charts(workbook, ec2_rows):
@@ -607,31 +1016,51 @@ def main():
 
     print("\n")
 
-    workbook = xlsxwriter.Workbook(args['filename'])
+    # Every sheet sets its column formats first and then writes strictly row
+    # by row, so let xlsxwriter flush each row to disk as it goes rather than
+    # holding the whole workbook in memory
+    workbook = xlsxwriter.Workbook(args['filename'],
+                                   {'constant_memory': True})
     currency_fmt = workbook.add_format({'num_format': '$#,##0.00'})
     percent_fmt = workbook.add_format()
     percent_fmt.set_num_format(9)
     # Get our ECS clieant and a list of all the ECS clusters
-    ecs = boto3.client('ecs')
+    ecs = get_ecs_client()
     clusters = get_cluster_list(ecs)
+    cluster_names = {cluster: get_display_name(cluster)
+                     for cluster in clusters}
     cluster_ec2_totals = {}
     cluster_ecs_totals = {}
-    # Do all the magic to tather the necessary information
-    for cluster in clusters:
-        print("Gathering info for ECS Cluster {}".format(
-            cluster.split("/")[1]))
-        cluster_ec2_totals[cluster] = get_container_stats(ecs, cluster)
-        cluster_ecs_totals[cluster] = get_service_stats(ecs, cluster,
-                                                        args['cpu_fudge'])
+    # Do all the magic to gather the necessary information.  This is almost
+    # all waiting on the AWS API, so gather the clusters in parallel.
+    if args['use_async']:
+        cluster_ec2_totals, cluster_ecs_totals = asyncio.run(
+            gather_clusters_async(clusters, args['cpu_fudge']))
+    else:
+        with ThreadPoolExecutor(max_workers=GATHER_WORKERS) as executor:
+            results = executor.map(
+                lambda cluster: gather_cluster_info(cluster,
+                                                    args['cpu_fudge']),
+                clusters)
+            for cluster, ec2_totals, ecs_totals in results:
+                cluster_ec2_totals[cluster] = ec2_totals
+                cluster_ecs_totals[cluster] = ecs_totals
+
+    # Look up all the EC2 prices we are going to need in one go
+    prefetch_ec2_prices(
+        args['location'], args['aws_discount'],
+        {totals['instance-type'] for totals in cluster_ec2_totals.values()
+         if totals['instance-count']})
 
     # Now create and populate the worksheets in that workbook
     ec2_rows = create_ec2_sheet(
-        workbook, currency_fmt, percent_fmt, cluster_ec2_totals, args)
+        workbook, currency_fmt, percent_fmt, cluster_ec2_totals,
+        cluster_names, args)
     fargate_rows = create_fargate_sheet(
-        workbook, currency_fmt, cluster_ecs_totals, args['fargate_discount'],
-        args['region'])
-    create_comparison_sheet(workbook, currency_fmt,
-                            cluster_ec2_totals, ec2_rows, fargate_rows)
+        workbook, currency_fmt, cluster_ecs_totals, cluster_names,
+        args['fargate_discount'], args['location'])
+    create_comparison_sheet(workbook, currency_fmt, cluster_ec2_totals,
+                            cluster_names, ec2_rows, fargate_rows)
     create_wasted_cpu_charts(workbook, ec2_rows)
     create_wasted_mem_charts(workbook, ec2_rows)
     workbook.close()